@@ -1,27 +1,60 @@
 # app.py
 
-from flask import Flask, session, jsonify, request, render_template
+# Patch the standard library before anything else imports socket/ssl/threading
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, Response, session, jsonify, request, render_template
 from flask_session import Session
-from flask_socketio import SocketIO, emit
+from flask_compress import Compress
+from flask_socketio import SocketIO, emit, join_room
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from eventlet.semaphore import Semaphore
 import os
-import json
-from datetime import datetime, timedelta
+import sys
+from datetime import datetime, timezone
 import uuid
+import hashlib
+import functools
+import time
 import logging
 import requests
-from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT
+import msgspec
+import orjson
+from pymongo import MongoClient, DESCENDING
+from pymongo.errors import PyMongoError
 from dotenv import load_dotenv
 import redis
 
 from utils import (
-    count_tokens,
+    get_tokenizer,
+    history_entry,
+    unsaved_messages,
+    revalidated_etag,
     manage_token_limits,
     allowed_file,
+    allowed_mimetype,
     file_size_under_limit,
     handle_file_chunks,
-    analyze_chunk_with_llama,
-    generate_conversation_text
+    split_into_chunks,
+    analyze_chunks,
+    iter_file_lines,
+    iter_completion_deltas,
+    post_completion,
+    OrjsonSerializer,
+    OrjsonProvider
+)
+from schemas import (
+    SendMessage,
+    FewShotExample,
+    ChatPayload,
+    CachedMessage,
+    validation_schema,
+    SCHEMA_HASH,
+    TEXT_INDEX_NAME,
+    CONVERSATION_KEY_INDEX,
+    CONVERSATION_INDEXES
 )
 
 # Load environment variables
@@ -30,136 +63,295 @@ load_dotenv()
 # Flask app initialization
 app = Flask(__name__, static_url_path='', static_folder='static', template_folder='templates')
 
+# Serialize jsonify responses with orjson
+app.json = OrjsonProvider(app)
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 # Securely obtain configuration variables
-AZURE_API_URL = os.getenv('AZURE_API_URL')
-API_KEY = os.getenv('API_KEY')
 SECRET_KEY = os.getenv('SECRET_KEY', 'default_secret_key')
 MONGODB_URI = os.getenv('MONGODB_URI')
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')  # Default Redis URL
 MAX_TOKENS = int(os.getenv('MAX_TOKENS', 128000))
 REPLY_TOKENS = int(os.getenv('REPLY_TOKENS', 800))
-CHUNK_SIZE_TOKENS = int(os.getenv('CHUNK_SIZE_TOKENS', 1000))
 MAX_FILE_SIZE_MB = float(os.getenv('MAX_FILE_SIZE_MB', '5.0'))
-ALLOWED_EXTENSIONS = set(os.getenv('ALLOWED_EXTENSIONS', 'txt,md,json').split(','))
-
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {API_KEY}"
-}
-
-# Initialize MongoDB client
-mongo_client = MongoClient(MONGODB_URI)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 200))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 20))
+MONGO_COMPRESSORS = os.getenv('MONGO_COMPRESSORS', 'zstd,zlib')
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 64))
+CONVERSATION_CACHE_TTL = int(os.getenv('CONVERSATION_CACHE_TTL', 3600))  # Seconds
+HISTORY_WINDOW = int(os.getenv('HISTORY_WINDOW', 200))  # Messages kept per conversation
+PROMPT_HISTORY_MESSAGES = min(int(os.getenv('PROMPT_HISTORY_MESSAGES', HISTORY_WINDOW)), HISTORY_WINDOW)  # Newest messages read to build a prompt
+STREAM_FLUSH_CHARS = int(os.getenv('STREAM_FLUSH_CHARS', 16384))
+STREAM_FLUSH_INTERVAL = float(os.getenv('STREAM_FLUSH_INTERVAL', 0.05))  # Seconds
+WATCH_CONVERSATIONS = os.getenv('WATCH_CONVERSATIONS', 'false').lower() == 'true'  # Needs a replica set (change streams)
+
+# Initialize MongoDB client with an explicitly sized, compressed connection pool
+mongo_client = MongoClient(
+    MONGODB_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=60000,
+    socketTimeoutMS=20000,
+    serverSelectionTimeoutMS=3000,
+    waitQueueTimeoutMS=2000,
+    compressors=MONGO_COMPRESSORS,  # zstd needs the zstandard package; zlib is built in and serves as the fallback
+    retryWrites=True
+)
 db = mongo_client['chatbot_db']
 conversations_collection = db['conversations']
 
+# Warm up the connection pool so the first requests don't pay the handshake cost
+try:
+    mongo_client.admin.command('ping')
+    logging.info("Connected to MongoDB successfully.")
+except Exception as e:
+    logging.error(f"MongoDB connection error: {e}")
+
 # Initialize Redis client
 try:
-    redis_client = redis.Redis.from_url(REDIS_URL)
+    # One bounded pool shared by the cache, Flask-Session and every greenlet
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=20,  # Seconds to wait for a free connection
+        socket_keepalive=True  # Keep idle pooled connections from being dropped by middleboxes
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
-    logging.info("Connected to Redis successfully.")
+    # redis-py switches to the C reply parser automatically when hiredis is installed
+    redis_parser = 'hiredis' if redis.utils.HIREDIS_AVAILABLE else 'pure Python'
+    logging.info(f"Connected to Redis successfully ({redis_parser} parser).")
 except redis.exceptions.ConnectionError as e:
     logging.error(f"Redis connection error: {e}")
     redis_client = None  # Handle accordingly if Redis is not available
 
+def conversation_cache_key(conversation_id, user_id):
+    """Returns the Redis key holding the cached history of a conversation."""
+    return f"conv:{conversation_id}:{user_id}"
+
+def is_valid_conversation_id(conversation_id):
+    """Checks that a client-supplied conversation ID has the UUID form start_conversation issues."""
+    try:
+        uuid.UUID(conversation_id)
+    except ValueError:
+        return False
+    return True
+
+cached_message_decoder = msgspec.msgpack.Decoder(CachedMessage)
+
+def encode_cached_message(entry):
+    """Encodes one history entry for the Redis cache (no per-message key names stored)."""
+    return msgspec.msgpack.encode(CachedMessage(entry['role'], entry['content'], entry.get('tokens')))
+
+def decode_cached_message(message):
+    """Turns a decoded CachedMessage back into a history entry."""
+    # Share one role string for all messages (decoding allocates a fresh copy per message)
+    entry = {'role': sys.intern(message.role), 'content': message.content}
+    if message.tokens is not None:
+        entry['tokens'] = message.tokens
+    return entry
+
+def get_cached_history(conversation_id, user_id, limit=HISTORY_WINDOW):
+    """Returns the newest `limit` cached messages, or None on a cache miss or when Redis is unavailable."""
+    if not redis_client:
+        return None
+    try:
+        cached = redis_client.lrange(conversation_cache_key(conversation_id, user_id), -limit, -1)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Redis cache read failed: {e}")
+        return None
+    try:
+        messages = [cached_message_decoder.decode(item) for item in cached]
+    except msgspec.DecodeError:
+        return None  # Written in an older format; the miss path rewrites it
+    # Redis drops empty lists, so an empty conversation reads as a miss and falls back to MongoDB
+    return [decode_cached_message(message) for message in messages] or None
+
+# Striped locks pairing each MongoDB history write with its cache update, so both see turns in one order
+conversation_locks = [Semaphore() for _ in range(64)]
+
+def conversation_lock(conversation_id, user_id):
+    """Returns the lock serializing history writes and cache refreshes of one conversation in this process."""
+    return conversation_locks[hash((conversation_id, user_id)) % len(conversation_locks)]
+
+def history_append(*entries):
+    """Builds the update that appends entries, keeping only the newest HISTORY_WINDOW messages."""
+    return {
+        '$push': {'conversation_history': {'$each': list(entries), '$slice': -HISTORY_WINDOW}},
+        # Total messages ever appended, so positions stay absolute once the window slides
+        '$inc': {'message_count': len(entries)},
+        '$currentDate': {'updated_at': True}
+    }
+
+def cache_history(conversation_id, user_id, conversation_history):
+    """Replaces the cached history (a Redis list, one msgpack item per message) so the next message can skip MongoDB."""
+    if not redis_client:
+        return
+    key = conversation_cache_key(conversation_id, user_id)
+    try:
+        # MULTI/EXEC so readers never observe a half-written list
+        pipeline = redis_client.pipeline(transaction=True)
+        pipeline.delete(key)
+        entries = conversation_history[-HISTORY_WINDOW:]
+        if entries:
+            pipeline.rpush(key, *(encode_cached_message(entry) for entry in entries))
+            pipeline.expire(key, CONVERSATION_CACHE_TTL)
+        pipeline.execute()
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Redis cache write failed: {e}")
+
+def append_cached_history(conversation_id, user_id, *entries):
+    """Appends messages to the cached history, if it is cached, without rewriting the earlier ones."""
+    if not redis_client:
+        return
+    key = conversation_cache_key(conversation_id, user_id)
+    try:
+        pipeline = redis_client.pipeline(transaction=True)
+        # RPUSHX only appends to an existing list, so an expired cache is never left partial
+        for entry in entries:
+            pipeline.rpushx(key, encode_cached_message(entry))
+        pipeline.ltrim(key, -HISTORY_WINDOW, -1)
+        pipeline.expire(key, CONVERSATION_CACHE_TTL)
+        pipeline.execute()
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Redis cache append failed: {e}")
+
+def invalidate_cached_history(conversation_id, user_id):
+    """Drops the cached history so the next read goes back to MongoDB."""
+    if not redis_client:
+        return
+    try:
+        redis_client.delete(conversation_cache_key(conversation_id, user_id))
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Redis cache invalidation failed: {e}")
+
 # Set secret key for session
 app.secret_key = SECRET_KEY
 
-# Initialize session
-app.config['SESSION_TYPE'] = 'redis' if redis_client else 'filesystem'
-app.config['SESSION_REDIS'] = redis_client if redis_client else None
+# Let Werkzeug reject oversize uploads before parsing the multipart body
+# (with a little headroom for the multipart boundaries and headers)
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_FILE_SIZE_MB * 1024 * 1024) + 64 * 1024
+
+# Initialize session: Redis-backed when available, otherwise Flask's signed cookie
+# session (the payload is only a couple of IDs) instead of per-request disk IO
 app.config['SESSION_PERMANENT'] = False
-Session(app)
+if redis_client:
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis_client,  # Shares the bounded connection pool
+        SESSION_SERIALIZATION_FORMAT='msgpack'
+    )
+    Session(app)
+
+# Compress JSON responses (conversation histories compress well); SocketIO traffic is unaffected
+app.config.update(
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_MIN_SIZE=512,
+    COMPRESS_STREAMS=True
+)
+Compress(app)
 
 # Initialize SocketIO with Redis as message queue
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     async_mode='eventlet',  # Ensure Eventlet is installed
-    message_queue=REDIS_URL if redis_client else None  # Use Redis for message queue
+    message_queue=REDIS_URL if redis_client else None,  # Use Redis for message queue
+    json=OrjsonSerializer  # C-accelerated packet encoding
 )
 
-# Validation schema for MongoDB (optional)
-validation_schema = {
-    '$jsonSchema': {
-        'bsonType': 'object',
-        'required': ['conversation_id', 'user_id', 'conversation_history', 'created_at'],
-        'properties': {
-            'conversation_id': {'bsonType': 'string'},
-            'user_id': {'bsonType': 'string'},
-            'conversation_history': {
-                'bsonType': 'array',
-                'items': {
-                    'bsonType': 'object',
-                    'required': ['role', 'content'],
-                    'properties': {
-                        'role': {'enum': ['user', 'assistant']},
-                        'content': {'bsonType': 'string'}
-                    }
-                }
-            },
-            'conversation_text': {'bsonType': 'string'},
-            'created_at': {'bsonType': 'date'},
-            'updated_at': {'bsonType': 'date'}
-        }
-    }
-}
-
-# Apply schema validation and create indexes
+# Apply schema validation and create indexes; only missing pieces cost a write
 def initialize_db():
     try:
-        # Apply validation schema
-        db.create_collection('conversations', validator=validation_schema)
-        logging.info("Collection 'conversations' created with schema validation.")
-    except Exception as e:
-        if 'already exists' in str(e):
+        if not db.list_collection_names(filter={'name': 'conversations'}):
+            # Apply validation schema
+            db.create_collection('conversations', validator=validation_schema)
+            db['meta'].update_one({'_id': 'validation_schema'}, {'$set': {'hash': SCHEMA_HASH}}, upsert=True)
+            logging.info("Collection 'conversations' created with schema validation.")
+        elif (db['meta'].find_one({'_id': 'validation_schema'}) or {}).get('hash') != SCHEMA_HASH:
+            # collMod is skipped entirely when the stored schema is unchanged
             db.command('collMod', 'conversations', validator=validation_schema)
+            db['meta'].update_one({'_id': 'validation_schema'}, {'$set': {'hash': SCHEMA_HASH}}, upsert=True)
             logging.info("Schema validation applied to existing 'conversations' collection.")
-        else:
-            logging.error(f"Error creating collection with validation: {e}")
+    except Exception as e:
+        logging.error(f"Error creating collection with validation: {e}")
 
-    # Create indexes
-    conversations_collection.create_index(
-        [('conversation_text', TEXT)],
-        name='conversation_text_index',
-        default_language='english'
-    )
-    logging.info("Text index created on 'conversation_text' field.")
+    backfill_message_count()
 
-    conversations_collection.create_index(
-        [('conversation_id', ASCENDING), ('user_id', ASCENDING)],
-        name='conversation_user_idx',
-        unique=True
-    )
-    logging.info("Unique index created on 'conversation_id' and 'user_id' fields.")
+    existing_indexes = conversations_collection.index_information()
+
+    # MongoDB allows only one text index per collection, so drop any superseded one
+    for name, info in existing_indexes.items():
+        if ('_fts', 'text') in info['key'] and name != TEXT_INDEX_NAME:
+            conversations_collection.drop_index(name)
+            logging.info(f"Dropped superseded text index '{name}'.")
 
-    conversations_collection.create_index(
-        [('created_at', DESCENDING)],
-        name='created_at_idx'
+    # Create indexes
+    for keys, options in CONVERSATION_INDEXES:
+        if options['name'] in existing_indexes:
+            continue
+        conversations_collection.create_index(keys, background=True, **options)
+        logging.info(f"Index '{options['name']}' created.")
+
+def backfill_message_count():
+    """Gives conversations stored before message_count existed a count covering their whole history (runs once)."""
+    if db['meta'].find_one({'_id': 'message_count_backfill'}):
+        return
+    # $inc on a legacy document starts from 0, so also repair counts that ended up below the stored history
+    result = conversations_collection.update_many(
+        {'$expr': {'$lt': [{'$ifNull': ['$message_count', 0]}, {'$size': '$conversation_history'}]}},
+        [{'$set': {'message_count': {'$max': [{'$ifNull': ['$message_count', 0]}, {'$size': '$conversation_history'}]}}}]
     )
-    logging.info("Index created on 'created_at' field.")
+    db['meta'].update_one({'_id': 'message_count_backfill'}, {'$set': {'done': True}}, upsert=True)
+    logging.info(f"Backfilled message_count on {result.modified_count} conversations.")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Applies the schema validator and creates any missing indexes."""
+    initialize_db()
 
-# Initialize the database
+# Initialize the database (cheap once the collection and indexes exist)
 initialize_db()
 
+# Parse the tokenizer's BPE ranks at startup rather than on the first message
+get_tokenizer()
+
+@functools.lru_cache(maxsize=1)
+def rendered_index():
+    """Renders the (static) main page once and returns its bytes with an ETag."""
+    body = render_template('index.html').encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=16).hexdigest()
+
 @app.route('/')
 def index():
     """Serve the main page of the application."""
-    return render_template('index.html')
+    if app.debug:
+        rendered_index.cache_clear()  # Pick up template edits while developing
+    body, etag = rendered_index()
+
+    response = Response(body, mimetype='text/html')
+    # Recognise the compressed ETag the browser got, so a revalidation is a 304 instead of a recompressed 200
+    response.set_etag(revalidated_etag(etag, request.if_none_match, app.config['COMPRESS_ALGORITHM']) or etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    # Answers If-None-Match with a bodiless 304 (left uncompressed by Flask-Compress)
+    return response.make_conditional(request)
 
 @app.route('/start_conversation', methods=['POST'])
 def start_conversation():
     """Starts a new conversation and assigns a unique conversation ID."""
-    conversation_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    conversation_id = uuid.uuid4().hex
     session['conversation_id'] = conversation_id
     user_id = session.get('user_id', 'anonymous')
 
     # Initialize empty conversation history
     conversation_history = []
-    conversation_text = ''
-    created_at = datetime.utcnow()
 
     # Save to MongoDB
     try:
@@ -167,9 +359,9 @@ def start_conversation():
             'conversation_id': conversation_id,
             'user_id': user_id,
             'conversation_history': conversation_history,
-            'conversation_text': conversation_text,
-            'created_at': created_at,
-            'updated_at': created_at
+            'message_count': 0,
+            'created_at': now,
+            'updated_at': now
         })
         logging.info(f"New conversation started with ID: {conversation_id}")
         return jsonify({"message": "New conversation started.", "conversation_id": conversation_id}), 200
@@ -190,12 +382,14 @@ def reset_conversation():
         # Reset conversation in MongoDB
         conversations_collection.update_one(
             {'conversation_id': conversation_id, 'user_id': user_id},
-            {'$set': {
-                'conversation_history': [],
-                'conversation_text': '',
-                'updated_at': datetime.utcnow()
-            }}
+            {
+                '$set': {'conversation_history': []},
+                '$currentDate': {'updated_at': True},  # Stamped by the server
+                '$unset': {'conversation_text': ''}  # Drop the legacy denormalized text
+            },
+            hint=CONVERSATION_KEY_INDEX
         )
+        invalidate_cached_history(conversation_id, user_id)
         logging.info(f"Conversation {conversation_id} has been reset.")
         return jsonify({"message": "Conversation has been reset successfully!"}), 200
     except Exception as e:
@@ -204,15 +398,32 @@ def reset_conversation():
 
 @app.route('/list_conversations', methods=['GET'])
 def list_conversations():
-    """Lists all conversations for the current user."""
+    """Lists the current user's conversations, newest first, one page at a time."""
     try:
         user_id = session.get('user_id', 'anonymous')
+        limit = min(max(request.args.get('limit', LIST_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        query = {'user_id': user_id}
+
+        # Keyset pagination: ?before=<ISO timestamp> returns conversations older than it
+        before = request.args.get('before')
+        if before:
+            try:
+                query['created_at'] = {'$lt': datetime.fromisoformat(before)}
+            except ValueError:
+                return jsonify({"message": "Invalid 'before' timestamp."}), 400
+
         conversations = conversations_collection.find(
-            {'user_id': user_id},
+            query,
             {'_id': 0, 'conversation_id': 1, 'created_at': 1}
-        ).sort('created_at', DESCENDING)
+        ).sort('created_at', DESCENDING).skip(offset).limit(limit)
         conversation_list = list(conversations)
-        return jsonify({"conversations": conversation_list}), 200
+
+        next_before = None
+        if len(conversation_list) == limit:
+            next_before = conversation_list[-1]['created_at'].isoformat()
+
+        return jsonify({"conversations": conversation_list, "next_before": next_before}), 200
     except Exception as e:
         logging.error(f"Error listing conversations: {e}")
         return jsonify({"message": "Failed to list conversations.", "error": str(e)}), 500
@@ -220,12 +431,21 @@ def list_conversations():
 @app.route('/load_conversation/<conversation_id>', methods=['GET'])
 def load_conversation(conversation_id):
     """Loads a conversation by ID."""
+    # Malformed IDs can never match, so answer them without a database round-trip
+    if not is_valid_conversation_id(conversation_id):
+        return jsonify({"message": "Invalid conversation ID."}), 400
+
     try:
         user_id = session.get('user_id', 'anonymous')
-        conversation = conversations_collection.find_one(
-            {'conversation_id': conversation_id, 'user_id': user_id},
-            {'_id': 0}
-        )
+        # Under the lock a turn being persisted can't land between this read and the cache refresh
+        with conversation_lock(conversation_id, user_id):
+            conversation = conversations_collection.find_one(
+                {'conversation_id': conversation_id, 'user_id': user_id},
+                {'_id': 0, 'conversation_history': 1},
+                hint=CONVERSATION_KEY_INDEX
+            )
+            if conversation:
+                cache_history(conversation_id, user_id, conversation['conversation_history'])
         if conversation:
             session['conversation_id'] = conversation_id
             logging.info(f"Conversation {conversation_id} loaded.")
@@ -239,7 +459,7 @@ def load_conversation(conversation_id):
 
 @app.route('/save_history', methods=['POST'])
 def save_history():
-    """Saves the current conversation history to a JSON file."""
+    """Appends the messages added since the last save to the conversation's JSONL file."""
     try:
         conversation_id = session.get('conversation_id')
         user_id = session.get('user_id', 'anonymous')
@@ -249,28 +469,64 @@ def save_history():
 
         conversation = conversations_collection.find_one(
             {'conversation_id': conversation_id, 'user_id': user_id},
-            {'_id': 0}
+            {'_id': 0, 'conversation_history': 1, 'message_count': 1, 'saved_upto': 1},
+            hint=CONVERSATION_KEY_INDEX
         )
 
         if not conversation:
             return jsonify({"message": "Conversation not found."}), 404
 
-        # Use a timestamp for unique filenames
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        file_name = f'{timestamp}_{conversation_id}_conversation_history.json'
+        # The cursor, kept on the conversation like the file it tracks, counts messages already written
+        new_messages, message_count = unsaved_messages(
+            conversation['conversation_history'],
+            conversation.get('message_count', 0),
+            conversation.get('saved_upto', 0)
+        )
 
-        # Ensure the directory exists
-        os.makedirs('saved_conversations', exist_ok=True)
+        file_name = f'{conversation_id}_conversation_history.jsonl'
 
-        with open(os.path.join('saved_conversations', file_name), 'w') as outfile:
-            json.dump(conversation, outfile, default=json_util.default)
+        # Serialize and write in the background so large histories don't block the hub
+        if new_messages:
+            socketio.start_background_task(
+                write_history_file, conversation_id, user_id, new_messages, message_count, file_name
+            )
 
-        logging.info(f"Conversation {conversation_id} saved as {file_name}.")
-        return jsonify({"message": "Conversation history saved successfully.", "file_name": file_name}), 200
+        logging.info(f"Saving {len(new_messages)} new messages of conversation {conversation_id} to {file_name}.")
+        return jsonify({"message": "Conversation history is being saved.", "file_name": file_name}), 202
     except Exception as e:
         logging.error(f"Error saving conversation: {str(e)}")
         return jsonify({"message": f"Failed to save conversation: {str(e)}"}), 500
 
+# Striped locks so concurrent saves of one conversation append its file one at a time
+history_file_locks = [Semaphore() for _ in range(64)]
+
+def write_history_file(conversation_id, user_id, messages, upto, file_name):
+    """Appends messages ending at position `upto` to a JSONL file in saved_conversations and advances saved_upto."""
+    key = {'conversation_id': conversation_id, 'user_id': user_id}
+    try:
+        with history_file_locks[hash(file_name) % len(history_file_locks)]:
+            # Re-read the cursor under the lock: an overlapping save may have written some of these already
+            saved = conversations_collection.find_one(key, {'_id': 0, 'saved_upto': 1}, hint=CONVERSATION_KEY_INDEX) or {}
+            unsaved = upto - saved.get('saved_upto', 0)
+            if unsaved <= 0:
+                return
+            messages = messages[-unsaved:]
+
+            # Ensure the directory exists
+            os.makedirs('saved_conversations', exist_ok=True)
+
+            # One append-mode open and a single write for the whole delta (portable, unlike os.writev)
+            data = b''.join(orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE) for message in messages)
+            with open(os.path.join('saved_conversations', file_name), 'ab') as history_file:
+                history_file.write(data)
+
+            # Advance the cursor only once the messages are on disk, so a failed write is retried next save
+            conversations_collection.update_one(key, {'$max': {'saved_upto': upto}}, hint=CONVERSATION_KEY_INDEX)
+
+        logging.info(f"Appended {len(messages)} messages to {file_name}.")
+    except Exception as e:
+        logging.error(f"Error writing conversation file {file_name}: {e}")
+
 @app.route('/search_conversations', methods=['GET'])
 def search_conversations():
     """Searches across all conversations for the current user."""
@@ -281,28 +537,26 @@ def search_conversations():
         if not query:
             return jsonify({"message": "No search query provided."}), 400
 
-        # Perform text search with relevance score
-        results = conversations_collection.find(
-            {
-                'user_id': user_id,
-                '$text': {'$search': query}
-            },
-            {
+        limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+
+        # Perform text search with relevance score, keeping only the requested page of top matches
+        results = conversations_collection.aggregate([
+            {'$match': {'user_id': user_id, '$text': {'$search': query}}},
+            {'$project': {
+                '_id': 0,
                 'conversation_id': 1,
                 'created_at': 1,
                 'updated_at': 1,
                 'score': {'$meta': 'textScore'}
-            }
-        ).sort([('score', {'$meta': 'textScore'})])
-
-        conversations = []
-        for conv in results:
-            conversations.append({
-                'conversation_id': conv['conversation_id'],
-                'created_at': conv['created_at'].isoformat(),
-                'updated_at': conv.get('updated_at', '').isoformat(),
-                'score': conv['score']
-            })
+            }},
+            {'$sort': {'score': {'$meta': 'textScore'}}},
+            {'$skip': offset},
+            {'$limit': limit}
+        ])
+
+        # The projection already has the response shape; jsonify encodes the datetimes
+        conversations = list(results)
 
         logging.info(f"Search completed for query: {query}")
         return jsonify({"conversations": conversations}), 200
@@ -314,12 +568,12 @@ def search_conversations():
 def add_few_shot_example():
     """Adds few-shot examples to the ongoing conversation."""
     try:
-        data = request.json
-        user_prompt = data.get("user_prompt")
-        assistant_response = data.get("assistant_response")
-
-        if not user_prompt or not assistant_response:
+        try:
+            example = msgspec.json.decode(request.get_data(), type=FewShotExample)
+        except msgspec.DecodeError:
             return jsonify({"message": "Both 'user_prompt' and 'assistant_response' are required."}), 400
+        user_prompt = example.user_prompt
+        assistant_response = example.assistant_response
 
         conversation_id = session.get('conversation_id')
         user_id = session.get('user_id', 'anonymous')
@@ -327,33 +581,20 @@ def add_few_shot_example():
         if not conversation_id:
             return jsonify({"message": "No active conversation. Please start a new conversation."}), 400
 
-        # Load conversation from MongoDB
-        conversation = conversations_collection.find_one(
-            {'conversation_id': conversation_id, 'user_id': user_id}
-        )
-
-        if not conversation:
-            return jsonify({"message": "Conversation not found."}), 404
-
-        conversation_history = conversation['conversation_history']
-        conversation_history.extend([
-            {"role": "user", "content": user_prompt},
-            {"role": "assistant", "content": assistant_response}
-        ])
+        example_entries = (history_entry("user", user_prompt), history_entry("assistant", assistant_response))
 
-        # Update conversation_text
-        conversation_text = generate_conversation_text(conversation_history)
-        updated_at = datetime.utcnow()
+        with conversation_lock(conversation_id, user_id):
+            # Append the example server-side without reading the stored history
+            result = conversations_collection.update_one(
+                {'conversation_id': conversation_id, 'user_id': user_id},
+                history_append(*example_entries),
+                hint=CONVERSATION_KEY_INDEX
+            )
+            if result.matched_count:
+                append_cached_history(conversation_id, user_id, *example_entries)
 
-        # Save updated conversation
-        conversations_collection.update_one(
-            {'conversation_id': conversation_id, 'user_id': user_id},
-            {'$set': {
-                'conversation_history': conversation_history,
-                'conversation_text': conversation_text,
-                'updated_at': updated_at
-            }}
-        )
+        if result.matched_count == 0:
+            return jsonify({"message": "Conversation not found."}), 404
 
         logging.info(f"Few-shot example added to conversation {conversation_id}.")
         return jsonify({"message": "Few-shot example added successfully!"}), 200
@@ -361,75 +602,111 @@ def add_few_shot_example():
         logging.error(f"Error adding few-shot example: {e}")
         return jsonify({"message": "Failed to add few-shot example.", "error": str(e)}), 500
 
+def user_room(user_id):
+    """Returns the SocketIO room every socket of a user joins."""
+    return f"user:{user_id}"
+
+def client_room(client_id):
+    """Returns the SocketIO room joined by the sockets of one browser session."""
+    return f"client:{client_id}"
+
+@socketio.on('connect')
+def handle_connect():
+    """Subscribes the socket to its user's room for conversation list updates, and to its session's room."""
+    join_room(user_room(session.get('user_id', 'anonymous')))
+    client_id = session.get('client_id')
+    if client_id:
+        join_room(client_room(client_id))
+
 @socketio.on('send_message')
 def handle_message(data):
     """Handles incoming messages via WebSocket."""
     try:
-        user_message = data.get('message')
-        conversation_id = session.get('conversation_id')
-        user_id = session.get('user_id', 'anonymous')
-
-        if not user_message:
+        try:
+            user_message = msgspec.convert(data, SendMessage).message
+        except msgspec.ValidationError:
             emit('error', {'message': 'No message received from user.'})
             return
 
+        conversation_id = session.get('conversation_id')
+        user_id = session.get('user_id', 'anonymous')
+
         if not conversation_id:
             emit('error', {'message': 'No active conversation. Please start a new conversation.'})
             return
 
-        # Load conversation history from MongoDB
-        conversation = conversations_collection.find_one({'conversation_id': conversation_id, 'user_id': user_id})
-        if conversation:
-            conversation_history = conversation['conversation_history']
-        else:
-            conversation_history = []
-
-        # Add user's message to conversation history
-        conversation_history.append({"role": "user", "content": user_message})
+        # The new message is the only one tokenized this turn; stored entries carry their counts
+        user_entry = history_entry("user", user_message)
+        conversation_history = get_cached_history(conversation_id, user_id, PROMPT_HISTORY_MESSAGES)
+
+        if conversation_history is None:
+            # Cache miss: load only the tail the prompt needs; the turn itself is written after the reply
+            with conversation_lock(conversation_id, user_id):
+                conversation = conversations_collection.find_one(
+                    {'conversation_id': conversation_id, 'user_id': user_id},
+                    {'_id': 0, 'conversation_id': 1, 'conversation_history': {'$slice': -PROMPT_HISTORY_MESSAGES}},
+                    hint=CONVERSATION_KEY_INDEX
+                )
+                if not conversation:
+                    emit('error', {'message': 'Conversation not found.'})
+                    return
+                conversation_history = conversation['conversation_history']
+                cache_history(conversation_id, user_id, conversation_history)
+
+        # The user's message reaches the cache only with its reply, in persist_turn, so the cache
+        # never holds an in-flight message and keeps the order of the MongoDB writes
+        conversation_history.append(user_entry)
+        del conversation_history[:-PROMPT_HISTORY_MESSAGES]
 
         # Manage token limits
-        conversation_history, total_tokens_used = manage_token_limits(conversation_history)
+        prompt_history, total_tokens_used = manage_token_limits(conversation_history, cache=redis_client)
         emit('token_usage', {'total_tokens_used': total_tokens_used})
 
         # Prepare payload for API request
-        payload = {
-            'messages': conversation_history,
-            'max_tokens': REPLY_TOKENS,
-            'temperature': 0.7,
-            'top_p': 0.95
-        }
-
-        # Make API request to Azure OpenAI
-        response = requests.post(AZURE_API_URL, headers=HEADERS, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
-
-        assistant_response = response_data.get('choices', [{}])[0].get('message', {}).get('content', '')
-
-        if assistant_response:
-            # Add assistant's response to conversation history
-            conversation_history.append({"role": "assistant", "content": assistant_response})
-
-            # Update conversation_text
-            conversation_text = generate_conversation_text(conversation_history)
-            updated_at = datetime.utcnow()
-
-            # Save updated conversation
-            conversations_collection.update_one(
-                {'conversation_id': conversation_id, 'user_id': user_id},
-                {'$set': {
-                    'conversation_history': conversation_history,
-                    'conversation_text': conversation_text,
-                    'updated_at': updated_at
-                }}
-            )
-
-            # Send the assistant's response to the client
-            emit('response_chunk', {'chunk': assistant_response})
-            logging.info(f"Assistant responded to conversation {conversation_id}.")
-        else:
-            emit('error', {'message': "No valid response from the API"})
-            logging.warning(f"No valid response received from API for conversation {conversation_id}.")
+        # Send only role and content; the stored token counts are not part of the API schema
+        payload = msgspec.json.encode(ChatPayload(
+            messages=[{'role': turn['role'], 'content': turn['content']} for turn in prompt_history],
+            max_tokens=REPLY_TOKENS
+        ))
+
+        assistant_entry = None
+        try:
+            # Stream the completion from Azure OpenAI, coalescing deltas so each emit
+            # (one WebSocket frame plus one message-queue publish) carries a batch of them
+            response_parts = []
+            pending_start = 0
+            pending_chars = 0
+            last_flush = time.monotonic()
+            with post_completion(payload, stream=True) as response:
+                response.raise_for_status()
+                for delta in iter_completion_deltas(response):
+                    response_parts.append(delta)
+                    pending_chars += len(delta)
+                    if pending_chars >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                        emit('response_chunk', {'chunk': ''.join(response_parts[pending_start:])})
+                        pending_start = len(response_parts)
+                        pending_chars = 0
+                        last_flush = time.monotonic()
+                        socketio.sleep(0)  # Yield to the eventlet hub between batches
+
+                if pending_chars:
+                    emit('response_chunk', {'chunk': ''.join(response_parts[pending_start:])})
+
+            assistant_response = ''.join(response_parts)
+
+            if assistant_response:
+                assistant_entry = history_entry("assistant", assistant_response)
+
+                # Only the reply is new; add its tokens to the prompt total instead of recounting the history
+                emit('token_usage', {'total_tokens_used': total_tokens_used + assistant_entry['tokens']})
+
+                logging.info(f"Assistant responded to conversation {conversation_id}.")
+            else:
+                emit('error', {'message': "No valid response from the API"})
+                logging.warning(f"No valid response received from API for conversation {conversation_id}.")
+        finally:
+            # One MongoDB write per turn, off the critical path; the user's message is kept even without a reply
+            socketio.start_background_task(persist_turn, conversation_id, user_id, user_entry, assistant_entry)
     except requests.RequestException as request_error:
         logging.error(f"Failed to communicate with API: {request_error}")
         emit('error', {'message': f"Failed to communicate with API: {request_error}"})
@@ -437,36 +714,136 @@ def handle_message(data):
         logging.error(f"Error handling message: {e}")
         emit('error', {'message': f"An unexpected error occurred: {e}"})
 
+def persist_turn(conversation_id, user_id, user_entry, assistant_entry=None):
+    """Appends a user message and the assistant's reply (if any) to the stored conversation in one write."""
+    try:
+        entries = [user_entry] if assistant_entry is None else [user_entry, assistant_entry]
+        with conversation_lock(conversation_id, user_id):
+            # Append the turn without rewriting the stored history
+            result = conversations_collection.update_one(
+                {'conversation_id': conversation_id, 'user_id': user_id},
+                history_append(*entries),
+                hint=CONVERSATION_KEY_INDEX
+            )
+            if result.matched_count == 0:
+                logging.warning(f"Conversation {conversation_id} disappeared before its turn was saved.")
+                invalidate_cached_history(conversation_id, user_id)
+            else:
+                # Cache the whole turn in one pipeline, in the same order as the MongoDB write
+                append_cached_history(conversation_id, user_id, *entries)
+    except Exception as e:
+        logging.error(f"Error saving turn for conversation {conversation_id}: {e}")
+        invalidate_cached_history(conversation_id, user_id)
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_entity_too_large(error):
+    """Returns a JSON 413 when a request body exceeds MAX_CONTENT_LENGTH (on any route, not just uploads)."""
+    return jsonify({"message": "Request body too large."}), 413
+
+# The config payload never changes at runtime, so it is encoded once
+CONFIG_BODY = orjson.dumps({"max_tokens": MAX_TOKENS})
+
 @app.route('/get_config', methods=['GET'])
 def get_config():
     """Returns configuration data like MAX_TOKENS."""
-    return jsonify({"max_tokens": MAX_TOKENS}), 200
+    # The page fetches this before opening its socket, so the socket joins this browser session's room
+    session.setdefault('client_id', uuid.uuid4().hex)
+    # A fresh Response per request: after_request hooks (compression, session) mutate it
+    return Response(CONFIG_BODY, mimetype='application/json'), 200
 
 @app.route('/upload_file', methods=['POST'])
 def upload_file():
     """Handles file uploads, validates and processes files."""
     try:
+        # Reject oversize bodies from the declared length, before the multipart body is parsed
+        if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({"message": f"File too large. Max size is {MAX_FILE_SIZE_MB:g}MB"}), 413
+
         if 'file' not in request.files or request.files['file'].filename == '':
             return jsonify({"message": "No file selected."}), 400
 
         file = request.files['file']
         filename = secure_filename(file.filename)
 
-        if not allowed_file(filename):
+        # The part's declared type is already parsed, so check it before the filename
+        if not allowed_mimetype(file.mimetype) or not allowed_file(filename):
             return jsonify({"message": "Unsupported file type."}), 400
 
         if not file_size_under_limit(file):
-            return jsonify({"message": "File too large. Max size is 5MB"}), 400
+            return jsonify({"message": f"File too large. Max size is {MAX_FILE_SIZE_MB:g}MB"}), 400
+
+        # Clients with a socket get the analysis pushed to it instead of holding the request open.
+        # It goes to this session's own room, never to a socket ID the client names
+        client_id = session.get('client_id')
+        if request.form.get('sid') and client_id:
+            # Chunk while the upload stream is still open; only the Azure calls run in the background
+            content_chunks = split_into_chunks(iter_file_lines(file.stream))
+            job_id = uuid.uuid4().hex
+            socketio.start_background_task(
+                run_file_analysis, job_id, client_room(client_id), filename, content_chunks, session.get('conversation', [])
+            )
+            logging.info(f"File uploaded, analysis job {job_id} started: {filename}")
+            return jsonify({"message": "File was uploaded; analysis is in progress.", "job_id": job_id}), 202
 
-        file_content = file.read().decode('utf-8')
-        _, full_analysis_result = handle_file_chunks(file_content)
+        _, full_analysis_result = handle_file_chunks(iter_file_lines(file.stream))
 
         logging.info(f"File uploaded and analyzed successfully: {filename}")
         return jsonify({"message": "File was uploaded and analyzed successfully.", "analysis": full_analysis_result}), 200
+    except RequestEntityTooLarge:
+        raise  # Body outgrew MAX_CONTENT_LENGTH while streaming; answered by the 413 handler
     except Exception as e:
         logging.error(f"Error uploading or analyzing file: {e}")
         return jsonify({"message": f"An error occurred: {e}"}), 500
 
+def run_file_analysis(job_id, room, filename, content_chunks, conversation_history):
+    """Analyzes uploaded file chunks and pushes the result to the uploading session's sockets."""
+    try:
+        full_analysis_result = analyze_chunks(content_chunks, conversation_history)
+        socketio.emit('analysis_ready', {
+            'job_id': job_id,
+            'message': "File was uploaded and analyzed successfully.",
+            'analysis': full_analysis_result
+        }, to=room)
+        logging.info(f"Analysis job {job_id} finished: {filename}")
+    except Exception as e:
+        logging.error(f"Error analyzing file {filename} (job {job_id}): {e}")
+        socketio.emit('error', {'message': f"An error occurred while analyzing {filename}: {e}", 'job_id': job_id}, to=room)
+
+def watch_conversations():
+    """Pushes each newly created conversation to its owner's sockets, so open lists stay fresh without polling."""
+    # Only inserts change the conversation list; project the few fields the client renders
+    pipeline = [
+        {'$match': {'operationType': 'insert'}},
+        {'$project': {
+            'fullDocument.conversation_id': 1,
+            'fullDocument.user_id': 1,
+            'fullDocument.created_at': 1
+        }}
+    ]
+    while True:
+        try:
+            with conversations_collection.watch(pipeline) as stream:
+                for change in stream:
+                    try:
+                        conversation = change['fullDocument']
+                        socketio.emit('conversation_added', {
+                            'conversation_id': conversation['conversation_id'],
+                            # MongoDB returns naive UTC datetimes
+                            'created_at': conversation['created_at'].replace(tzinfo=timezone.utc).isoformat()
+                        }, to=user_room(conversation['user_id']))
+                    except Exception as e:
+                        # A malformed document or a failed emit skips this event, not the watcher
+                        logging.error(f"Error pushing conversation change {change.get('_id')}: {e}")
+        except PyMongoError as e:
+            logging.error(f"Conversation change stream failed, reopening: {e}")
+            socketio.sleep(5)
+        except Exception as e:
+            logging.error(f"Unexpected error in conversation watcher, reopening: {e}")
+            socketio.sleep(5)
+
+if WATCH_CONVERSATIONS:
+    socketio.start_background_task(watch_conversations)
+
 if __name__ == '__main__':
     # Launch the Flask app with SocketIO enabled using Eventlet
     socketio.run(app, debug=True, port=5000)
\ No newline at end of file
@@ -1,8 +1,7 @@
 import os
 from pymongo import MongoClient
-from bson import json_util
-from datetime import datetime
-from app import validation_schema, update_conversation_text
+# schemas holds only definitions, so this script does not start the Flask/SocketIO app
+from schemas import validation_schema, SCHEMA_HASH, TEXT_INDEX_NAME, CONVERSATION_INDEXES
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -25,22 +24,18 @@ except Exception as e:
     else:
         print(f"An error occurred: {e}")
 
-# Create indexes
-conversations_collection.create_index(
-    [('conversation_text', 'text')],
-    name='conversation_text_index',
-    default_language='english'
-)
+# Record the applied schema's hash so app startup can skip collMod
+db['meta'].update_one({'_id': 'validation_schema'}, {'$set': {'hash': SCHEMA_HASH}}, upsert=True)
 
-conversations_collection.create_index(
-    [('conversation_id', 1), ('user_id', 1)],
-    name='conversation_user_idx',
-    unique=True
-)
+# MongoDB allows only one text index per collection, so drop any superseded one
+# (rebuilding the text index when its fields or options change)
+for name, info in conversations_collection.index_information().items():
+    if ('_fts', 'text') in info['key'] and name != TEXT_INDEX_NAME:
+        conversations_collection.drop_index(name)
+        print(f"Superseded text index '{name}' dropped.")
 
-conversations_collection.create_index(
-    [('created_at', -1)],
-    name='created_at_idx'
-)
+# Create indexes
+for keys, options in CONVERSATION_INDEXES:
+    conversations_collection.create_index(keys, **options)
 
 print("Indexes created successfully.")
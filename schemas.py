@@ -0,0 +1,94 @@
+# schemas.py
+
+import hashlib
+from typing import Annotated, Optional
+
+import msgspec
+import orjson
+from pymongo import ASCENDING, DESCENDING, TEXT
+
+NonEmptyStr = Annotated[str, msgspec.Meta(min_length=1)]
+
+class SendMessage(msgspec.Struct):
+    """Payload of the 'send_message' SocketIO event."""
+    message: NonEmptyStr
+
+class FewShotExample(msgspec.Struct):
+    """Request body of the '/add_few_shot_example' route."""
+    user_prompt: NonEmptyStr
+    assistant_response: NonEmptyStr
+
+class ChatPayload(msgspec.Struct):
+    """Request body of a streamed chat completion sent to Azure."""
+    messages: list
+    max_tokens: int
+    temperature: float = 0.7
+    top_p: float = 0.95
+    stream: bool = True
+
+class CachedMessage(msgspec.Struct, array_like=True, gc=False):
+    """A conversation message as stored in the Redis history cache, encoded as a compact [role, content, tokens] array."""
+    role: str
+    content: str
+    tokens: Optional[int] = None  # Absent in entries cached before token counts were stored
+
+# Validation schema for MongoDB (optional)
+validation_schema = {
+    '$jsonSchema': {
+        'bsonType': 'object',
+        'required': ['conversation_id', 'user_id', 'conversation_history', 'created_at'],
+        'properties': {
+            'conversation_id': {'bsonType': 'string'},
+            'user_id': {'bsonType': 'string'},
+            'conversation_history': {
+                'bsonType': 'array',
+                'items': {
+                    'bsonType': 'object',
+                    'required': ['role', 'content'],
+                    'properties': {
+                        'role': {'enum': ['user', 'assistant']},
+                        'content': {'bsonType': 'string'},
+                        'tokens': {'bsonType': ['int', 'long']}  # Token count of content, set on insert
+                    }
+                }
+            },
+            'message_count': {'bsonType': ['int', 'long']},
+            'saved_upto': {'bsonType': ['int', 'long']},  # Messages already appended to the saved JSONL file
+            'created_at': {'bsonType': 'date'},
+            'updated_at': {'bsonType': 'date'}
+        }
+    }
+}
+
+TEXT_INDEX_NAME = 'user_text_idx'
+
+# Unique index serving every lookup by (conversation_id, user_id); hinted to skip query planning
+CONVERSATION_KEY_INDEX = 'conversation_user_idx'
+
+# Fingerprint of validation_schema; startup re-applies the validator only when it changes
+SCHEMA_HASH = hashlib.sha256(orjson.dumps(validation_schema, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+# Indexes on the conversations collection: (keys, create_index options)
+CONVERSATION_INDEXES = [
+    (
+        # user_id prefix: searches (always scoped to one user) scan only that user's text keys
+        [('user_id', ASCENDING), ('conversation_history.content', TEXT)],
+        dict(
+            name=TEXT_INDEX_NAME,
+            default_language='none',  # Chat content is mixed-language; skip stemming and stop words
+            weights={'conversation_history.content': 1}
+        )
+    ),
+    (
+        [('conversation_id', ASCENDING), ('user_id', ASCENDING)],
+        dict(name=CONVERSATION_KEY_INDEX, unique=True)
+    ),
+    (
+        [('created_at', DESCENDING)],
+        dict(name='created_at_idx')
+    ),
+    (
+        [('user_id', ASCENDING), ('created_at', DESCENDING), ('conversation_id', ASCENDING)],
+        dict(name='user_created_covering_idx')
+    ),
+]
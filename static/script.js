@@ -2,7 +2,9 @@
 
 document.addEventListener('DOMContentLoaded', () => {
     // Initialize Socket.IO connection
+    // Connected once the config request has established the session (see getConfig below)
     const socket = io({
+        autoConnect: false,
         transports: ['websocket'],
         reconnection: true,
         reconnectionDelay: 1000,
@@ -30,6 +32,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // Global Variables
     let MAX_TOKENS = 128000; // Default value
     let currentConversationId = sessionStorage.getItem('conversation_id') || null;
+    let streamingMessageElement = null; // Assistant message currently receiving streamed chunks
 
     // DOM Elements
     const chatHistory = document.getElementById('chat-history');
@@ -119,6 +122,8 @@ document.addEventListener('DOMContentLoaded', () => {
     socket.on('response_chunk', handleResponseChunk);
     socket.on('error', handleError);
     socket.on('token_usage', updateTokenUsage);
+    socket.on('analysis_ready', handleAnalysisReady);
+    socket.on('conversation_added', handleConversationAdded);
 
     // Global Error Handler
     window.addEventListener('unhandledrejection', function(event) {
@@ -151,6 +156,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!message) return;
 
         appendMessage('user', message);
+        streamingMessageElement = null;
 
         socket.emit('send_message', { message: message }, (error) => {
             if (error) {
@@ -171,11 +177,18 @@ document.addEventListener('DOMContentLoaded', () => {
         messageElement.textContent = content;
         chatHistory.appendChild(messageElement);
         chatHistory.scrollTop = chatHistory.scrollHeight;
+        return messageElement;
     }
 
     function handleResponseChunk(data) {
         if (data && data.chunk) {
-            appendMessage('assistant', data.chunk);
+            // Chunks of one reply are streamed in order; grow a single message element
+            if (!streamingMessageElement) {
+                streamingMessageElement = appendMessage('assistant', data.chunk);
+            } else {
+                streamingMessageElement.textContent += data.chunk;
+                chatHistory.scrollTop = chatHistory.scrollHeight;
+            }
         } else {
             console.error('Invalid data received in handleResponseChunk.');
         }
@@ -229,22 +242,39 @@ document.addEventListener('DOMContentLoaded', () => {
             conversationList.appendChild(listItem);
         } else {
             conversations.forEach(conv => {
-                const listItem = document.createElement('li');
+                conversationList.appendChild(createConversationListItem(conv));
+            });
+        }
+    }
 
-                const span = document.createElement('span');
-                const createdAt = new Date(conv.created_at).toLocaleString();
-                span.textContent = `Conversation ${createdAt}`;
-                listItem.appendChild(span);
+    function createConversationListItem(conv) {
+        const listItem = document.createElement('li');
+        listItem.dataset.conversationId = conv.conversation_id;
 
-                const loadButton = document.createElement('button');
-                loadButton.textContent = 'Load';
-                loadButton.classList.add('btn', 'btn-sm', 'btn-primary');
-                loadButton.addEventListener('click', () => loadConversation(conv.conversation_id));
-                listItem.appendChild(loadButton);
+        const span = document.createElement('span');
+        const createdAt = new Date(conv.created_at).toLocaleString();
+        span.textContent = `Conversation ${createdAt}`;
+        listItem.appendChild(span);
 
-                conversationList.appendChild(listItem);
-            });
+        const loadButton = document.createElement('button');
+        loadButton.textContent = 'Load';
+        loadButton.classList.add('btn', 'btn-sm', 'btn-primary');
+        loadButton.addEventListener('click', () => loadConversation(conv.conversation_id));
+        listItem.appendChild(loadButton);
+
+        return listItem;
+    }
+
+    function handleConversationAdded(conv) {
+        // Pushed by the server when one of this user's conversations is created
+        if (conversationList.querySelector(`li[data-conversation-id="${conv.conversation_id}"]`)) {
+            return;
+        }
+        const placeholder = conversationList.querySelector('li:not([data-conversation-id])');
+        if (placeholder) {
+            placeholder.remove();
         }
+        conversationList.prepend(createConversationListItem(conv));
     }
 
     async function loadConversation(conversationId) {
@@ -349,6 +379,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const formData = new FormData();
         formData.append('file', file);
+        if (socket.connected) {
+            formData.append('sid', socket.id); // Ask for the analysis to be pushed to this session's sockets
+        }
 
         try {
             const response = await fetch('/upload_file', { method: 'POST', body: formData });
@@ -357,12 +390,19 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(data.message || 'Error uploading file.');
             }
             notyf.success(data.message);
-            appendMessage('assistant', data.analysis);
+            if (data.analysis) {
+                appendMessage('assistant', data.analysis);
+            }
         } catch (error) {
             notyf.error(error.message || 'Error uploading file. Please try again.');
         }
     }
 
+    function handleAnalysisReady(data) {
+        notyf.success(data.message);
+        appendMessage('assistant', data.analysis);
+    }
+
     // Utility function for fetch requests with error handling
     async function fetchJSON(url, options = {}) {
         try {
@@ -390,8 +430,8 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    // Initialize the app
-    getConfig();
+    // Initialize the app; the socket connects with the session cookie set by /get_config
+    getConfig().finally(() => socket.connect());
     listConversations();
 
     // If there's a current conversation ID, load it
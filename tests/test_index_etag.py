@@ -0,0 +1,55 @@
+# test_index_etag.py
+
+import hashlib
+
+from flask import Flask, Response, request
+from flask_compress import Compress
+
+from utils import revalidated_etag
+
+BODY = b"<html><body>" + b"chat " * 500 + b"</body></html>"
+ETAG = hashlib.blake2b(BODY, digest_size=16).hexdigest()
+
+
+def make_app():
+    # Serves a page the way app.index does, behind Flask-Compress with the app's algorithms
+    app = Flask(__name__)
+    app.config.update(COMPRESS_ALGORITHM=['br', 'gzip'], COMPRESS_MIN_SIZE=512)
+    Compress(app)
+
+    @app.route('/')
+    def index():
+        response = Response(BODY, mimetype='text/html')
+        response.set_etag(revalidated_etag(ETAG, request.if_none_match, app.config['COMPRESS_ALGORITHM']) or ETAG)
+        return response.make_conditional(request)
+
+    return app
+
+
+def test_revalidation_with_compressed_etag_returns_304():
+    client = make_app().test_client()
+    for encoding in ('br', 'gzip'):
+        first = client.get('/', headers={'Accept-Encoding': encoding})
+        assert first.status_code == 200
+        assert first.headers['Content-Encoding'] == encoding
+        assert first.headers['ETag'] == f'"{ETAG}:{encoding}"'
+
+        repeat = client.get('/', headers={'Accept-Encoding': encoding, 'If-None-Match': first.headers['ETag']})
+        assert repeat.status_code == 304
+        assert repeat.data == b''
+
+
+def test_revalidation_with_plain_etag_returns_304():
+    client = make_app().test_client()
+    first = client.get('/', headers={'Accept-Encoding': 'identity'})
+    assert first.headers['ETag'] == f'"{ETAG}"'
+
+    repeat = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+    assert repeat.status_code == 304
+
+
+def test_stale_etag_returns_full_page():
+    client = make_app().test_client()
+    response = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"stale:gzip"'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
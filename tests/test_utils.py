@@ -0,0 +1,43 @@
+# test_utils.py
+
+from utils import allowed_file, allowed_mimetype, unsaved_messages
+
+
+def make_history(count, start=0):
+    return [{"role": "user", "content": f"message {i}"} for i in range(start, start + count)]
+
+
+def test_unsaved_messages_from_saved_cursor():
+    history = make_history(10)
+    messages, upto = unsaved_messages(history, 10, 6)
+    assert messages == history[6:]
+    assert upto == 10
+
+
+def test_unsaved_messages_after_window_slide():
+    # 250 messages appended, only the newest 200 stored, 100 already saved
+    history = make_history(200, start=50)
+    messages, upto = unsaved_messages(history, 250, 100)
+    assert messages == history[50:]
+    assert upto == 250
+
+
+def test_legacy_conversation_saved_after_one_more_turn():
+    # Stored with 40 messages before message_count existed; the next turn's $inc created message_count = 2
+    history = make_history(42)
+    messages, upto = unsaved_messages(history, 2, 0)
+    assert messages == history
+    assert upto == 42
+
+    # The following turn only adds its two messages to the file
+    history = make_history(44)
+    messages, upto = unsaved_messages(history, 4, upto)
+    assert messages == history[42:]
+    assert upto == 44
+
+
+def test_upload_without_declared_mimetype_falls_back_to_extension():
+    assert allowed_mimetype('') and allowed_mimetype(None)
+    assert allowed_mimetype('application/octet-stream')
+    assert allowed_file('notes.md')
+    assert not allowed_mimetype('image/png')
@@ -1,9 +1,18 @@
 import os
-import json
-from flask import session
-from datetime import datetime
+import codecs
+import hashlib
+import functools
+import itertools
+from flask import session, request
+from flask.json.provider import JSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tiktoken
+import orjson
+import eventlet
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
 import logging
 
 # Load environment variables from a .env file
@@ -20,51 +29,191 @@ CHUNK_SIZE_TOKENS = int(os.getenv('CHUNK_SIZE_TOKENS', 1000))
 # Parse MAX_FILE_SIZE_MB
 MAX_FILE_SIZE_MB = float(os.getenv('MAX_FILE_SIZE_MB', '5.0').rstrip('m'))
 
-ALLOWED_EXTENSIONS = set(os.getenv('ALLOWED_EXTENSIONS', 'txt,md,json').split(','))
+ALLOWED_EXTENSIONS = frozenset(ext.strip().lower() for ext in os.getenv('ALLOWED_EXTENSIONS', 'txt,md,json').split(','))
+
+# Declared part Content-Types accepted for uploads (browsers often send octet-stream for .md)
+ALLOWED_MIMETYPES = frozenset(
+    mimetype.strip().lower() for mimetype in os.getenv(
+        'ALLOWED_MIMETYPES',
+        'text/plain,text/markdown,text/x-markdown,application/json,application/octet-stream'
+    ).split(',')
+)
+
+# Number of distinct strings whose token counts are memoized in-process
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 10000))
+# Longer strings are counted without being memoized, so the cache's memory stays bounded
+TOKEN_COUNT_CACHE_MAX_CHARS = int(os.getenv('TOKEN_COUNT_CACHE_MAX_CHARS', 2048))
+
+# Seconds a message's cached token count is kept in Redis
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 86400))
+
+# Number of uploaded file lines tokenized per hand-off to a native thread
+TOKENIZE_BATCH_LINES = int(os.getenv('TOKENIZE_BATCH_LINES', 1024))
+
+# Number of file chunks analyzed concurrently
+ANALYSIS_CONCURRENCY = int(os.getenv('ANALYSIS_CONCURRENCY', 8))
+# Process-wide cap on in-flight chunk analyses across all uploads, to stay under Azure rate limits
+ANALYSIS_MAX_IN_FLIGHT = int(os.getenv('ANALYSIS_MAX_IN_FLIGHT', 16))
 
 HEADERS = {
     "Content-Type": "application/json",
     "Authorization": f"Bearer {API_KEY}"
 }
 
-# Load tokenizer
-encoding = tiktoken.get_encoding("cl100k_base")
+# (connect, read) timeouts for calls to the Azure API
+AZURE_TIMEOUT = (3, 60)
+
+# Shared HTTP session so TCP/TLS connections to Azure are reused across requests
+azure_session = requests.Session()
+azure_session.headers.update(HEADERS)
+azure_session.mount('https://', HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    # Retry transient connection failures and throttling/gateway errors with a short backoff
+    # (honouring Retry-After); completions have no side effects, so POST is safe to resend
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,  # Wait as long as a throttled (429/503) response asks
+        allowed_methods=frozenset({'POST'})
+    )
+))
+
+@functools.lru_cache(maxsize=1)
+def completion_request_template():
+    """Builds (once) the prepared Azure POST; URL parsing and header merging happen here only."""
+    return azure_session.prepare_request(requests.Request('POST', AZURE_API_URL))
+
+def post_completion(body, stream=False):
+    """
+    Sends a chat completion request to Azure from the prepared template.
+
+    Args:
+        body (bytes): The JSON-encoded request body.
+        stream (bool): Whether to stream the response body.
+
+    Returns:
+        requests.Response: The API response.
+    """
+    prepared = completion_request_template().copy()
+    prepared.prepare_body(body, None)  # Also sets Content-Length
+    return azure_session.send(prepared, timeout=AZURE_TIMEOUT, stream=stream)
+
+class OrjsonSerializer:
+    """Drop-in ``json`` module replacement backed by orjson, e.g. for SocketIO packet encoding."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson always produces compact output, so formatting kwargs such as separators are ignored
+        return orjson.dumps(obj).decode('utf-8')
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by ``jsonify`` and ``request.get_json``."""
+
+    def dumps(self, obj, **kwargs):
+        # Naive datetimes from MongoDB are stored as UTC
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+analysis_slots = Semaphore(ANALYSIS_MAX_IN_FLIGHT)
+
+@functools.cache
+def get_tokenizer():
+    """Returns the cl100k_base tokenizer, loading its BPE ranks on first use."""
+    return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def _count_tokens_memoized(text):
+    return len(get_tokenizer().encode_ordinary(text))
 
 def count_tokens(text):
-    """Count tokens in the text using the tokenizer."""
-    return len(encoding.encode(text))
-def generate_conversation_text(conversation_history):
+    """Count tokens in the text using the tokenizer (short texts are memoized: past messages never change)."""
+    # encode_ordinary skips the special-token scan: user text is plain text, even if it contains '<|endoftext|>'
+    if len(text) > TOKEN_COUNT_CACHE_MAX_CHARS:
+        return len(get_tokenizer().encode_ordinary(text))
+    return _count_tokens_memoized(text)
+
+def _encode_lengths(texts):
+    encoding = get_tokenizer()
+    return [len(encoding.encode_ordinary(text)) for text in texts]
+
+def count_tokens_batch(texts):
+    """Counts the tokens of each text in one hand-off to eventlet's native thread pool."""
+    if not texts:
+        return []
+    # The tokenizer releases the GIL, so the hub keeps serving other greenlets meanwhile
+    return tpool.execute(_encode_lengths, texts)
+
+def history_entry(role, content):
+    """Builds a history entry, storing its token count so later prompts never re-tokenize it."""
+    return {'role': role, 'content': content, 'tokens': count_tokens(content)}
+
+def count_tokens_cached(texts, cache=None):
     """
-    Generates a text summary of the conversation by concatenating user and assistant messages.
-    
+    Counts tokens for each text, reusing counts cached in Redis under a hash of the content.
+
     Args:
-        conversation_history (list): A list of dictionaries representing the conversation history.
-                                     Each dictionary contains 'role' and 'content' keys.
-    
+        texts (list): The strings to count.
+        cache (redis.Redis, optional): Client used for the cache; without one every text is tokenized.
+
     Returns:
-        str: A concatenated string representation of the conversation.
+        list: The token count of each text, in order.
     """
-    conversation_text = ""
-    
-    for message in conversation_history:
-        role = message.get('role', 'user')
-        content = message.get('content', '')
-        
-        if role == 'user':
-            conversation_text += f"User: {content}\n"
-        elif role == 'assistant':
-            conversation_text += f"Assistant: {content}\n"
-    
-    return conversation_text.strip()  # Remove any trailing newlines
+    if cache is None:
+        return count_tokens_batch(texts)
 
+    keys = ['tok:' + hashlib.sha1(text.encode('utf-8')).hexdigest()[:16] for text in texts]
+    try:
+        # One round-trip for the whole history instead of one BPE pass per message
+        cached_counts = cache.mget(keys)
+    except Exception as e:
+        logging.warning(f"Token count cache read failed: {e}")
+        return count_tokens_batch(texts)
+
+    counts = [None if cached is None else int(cached) for cached in cached_counts]
+    missing = [i for i, count in enumerate(counts) if count is None]
+
+    if missing:
+        # Tokenize every cache miss in a single batch
+        for i, count in zip(missing, count_tokens_batch([texts[i] for i in missing])):
+            counts[i] = count
+        try:
+            pipeline = cache.pipeline(transaction=False)
+            for i in missing:
+                pipeline.set(keys[i], counts[i], ex=TOKEN_CACHE_TTL)
+            pipeline.execute()
+        except Exception as e:
+            logging.warning(f"Token count cache write failed: {e}")
+
+    return counts
+
+def unsaved_messages(history, message_count, saved_upto):
+    """
+    Returns the stored messages not yet written to the saved history file.
+
+    Args:
+        history (list): The stored window of the conversation (its newest messages).
+        message_count (int): Total messages ever appended to the conversation.
+        saved_upto (int): Number of messages already written to the file.
+
+    Returns:
+        tuple: The unsaved messages and the position the file reaches once they are written.
+    """
+    # Conversations stored before message_count existed under-count; the window can't hold more than were appended
+    message_count = max(message_count, len(history))
+    window_start = message_count - len(history)
+    return history[max(saved_upto - window_start, 0):], message_count
 
 def summarize_messages(messages, max_summary_tokens=500):
     """Summarizes a list of messages into a shorter text."""
-    combined_text = ""
-    for msg in messages:
-        role = msg['role']
-        content = msg['content']
-        combined_text += f"{role.capitalize()}: {content}\n"
+    combined_text = "".join(f"{msg['role'].capitalize()}: {msg['content']}\n" for msg in messages)
 
     prompt = f"Please provide a concise summary of the following conversation:\n{combined_text}\nSummary:"
 
@@ -78,110 +227,205 @@ def summarize_messages(messages, max_summary_tokens=500):
     }
 
     try:
-        response = requests.post(AZURE_API_URL, headers=HEADERS, json=payload)
+        response = post_completion(orjson.dumps(payload))
         response.raise_for_status()
-        summary_response = response.json()
+        summary_response = orjson.loads(response.content)
         summary_content = summary_response['choices'][0]['message']['content'].strip()
-        return {"role": "system", "content": f"Summary: {summary_content}"}
+        return history_entry("system", f"Summary: {summary_content}")
     except Exception as e:
         logging.error(f"Error during summarization: {str(e)}")
-        return {"role": "system", "content": "Summary not available due to an error."}
+        return history_entry("system", "Summary not available due to an error.")
 
-def manage_token_limits(conversation_history, new_message=None):
+def manage_token_limits(conversation_history, new_message=None, cache=None):
     """Manages the token limits by summarizing older messages when necessary."""
     if new_message:
-        temp_history = conversation_history + [{"role": "user", "content": new_message}]
+        temp_history = conversation_history + [history_entry("user", new_message)]
     else:
         temp_history = conversation_history.copy()
 
-    total_tokens = sum(count_tokens(turn['content']) for turn in temp_history)
+    # Stored entries carry their token count; only entries saved without one are tokenized
+    counts = [turn.get('tokens') for turn in temp_history]
+    uncounted = [i for i, count in enumerate(counts) if count is None]
+    if uncounted:
+        for i, count in zip(uncounted, count_tokens_cached([temp_history[i]['content'] for i in uncounted], cache)):
+            counts[i] = count
+    total_tokens = sum(counts)
 
     if total_tokens >= MAX_TOKENS - REPLY_TOKENS:
-        messages_to_summarize = []
-        while total_tokens >= MAX_TOKENS - REPLY_TOKENS and len(temp_history) > 1:
-            messages_to_summarize.append(temp_history.pop(0))
-            total_tokens = sum(count_tokens(turn['content']) for turn in temp_history)
+        # Walk the oldest messages off a running total instead of re-summing the history per pop
+        cutoff = 0
+        while total_tokens >= MAX_TOKENS - REPLY_TOKENS and len(temp_history) - cutoff > 1:
+            total_tokens -= counts[cutoff]
+            cutoff += 1
 
-        if messages_to_summarize:
-            summary_message = summarize_messages(messages_to_summarize)
-            temp_history.insert(0, summary_message)
-            total_tokens = sum(count_tokens(turn['content']) for turn in temp_history)
+        if cutoff:
+            summary_message = summarize_messages(temp_history[:cutoff])
+            temp_history = [summary_message] + temp_history[cutoff:]
+            total_tokens += summary_message['tokens']
 
             if total_tokens >= MAX_TOKENS - REPLY_TOKENS:
-                return manage_token_limits(temp_history)
+                return manage_token_limits(temp_history, cache=cache)
 
-    else:
-        temp_history = conversation_history.copy()
+    return temp_history, total_tokens
 
-    if new_message:
-        temp_history.append({"role": "user", "content": new_message})
-        total_tokens += count_tokens(new_message)
+def iter_completion_deltas(response):
+    """
+    Yields the content deltas from a streamed (server-sent events) chat completion.
 
-    return temp_history, total_tokens
+    Args:
+        response (requests.Response): A response opened with ``stream=True`` for a
+                                      payload that set ``'stream': True``.
+
+    Yields:
+        str: Each non-empty piece of the assistant's reply, in order.
+    """
+    # Read in 8 KB blocks rather than the 512-byte default; frames stay bytes for orjson
+    for line in response.iter_lines(chunk_size=8192):
+        if not line.startswith(b'data: '):
+            continue
+
+        data = line[len(b'data: '):]
+        if data.strip() == b'[DONE]':
+            break
+
+        choices = orjson.loads(data).get('choices') or [{}]
+        delta = choices[0].get('delta', {}).get('content')
+        if delta:
+            yield delta
 
 def allowed_file(filename):
     """Checks if a given file is allowed based on its extension."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+def allowed_mimetype(mimetype):
+    """Checks the Content-Type a client declared for an uploaded file."""
+    # No declared type (curl, some browsers for .md) is unknown, not wrong: the extension check decides
+    return not mimetype or mimetype in ALLOWED_MIMETYPES
 
 def file_size_under_limit(file):
     """Ensures that the uploaded file size is within the allowed limit."""
+    # A file can't be larger than the whole request body, so a small enough body needs no seeking
+    content_length = request.content_length
+    if content_length is not None and content_length <= MAX_FILE_SIZE_MB * 1024 * 1024:
+        return True
+
+    # Chunked uploads (no Content-Length) or bodies only slightly over: measure the file itself
     file.seek(0, os.SEEK_END)
     size_bytes = file.tell()
     file_size_mb = size_bytes / (1024 * 1024)
     file.seek(0)
     return file_size_mb <= MAX_FILE_SIZE_MB
 
-def handle_file_chunks(file_content):
-    """Break file content into smaller tokenized chunks and analyze them via Llama API."""
-    content_chunks = []
-    current_chunk = ""
-    current_token_count = 0
+def revalidated_etag(etag, if_none_match, algorithms):
+    """
+    Returns the form of `etag` a conditional request already holds, or None if it holds none.
 
-    lines = file_content.splitlines()
+    Flask-Compress rewrites the ETag of a compressed response to "<etag>:<algorithm>", so browsers
+    revalidate with that form rather than the one the view set.
 
-    # Tokenize and break into manageable chunks
-    for line in lines:
-        tokens_in_line = count_tokens(line)
+    Args:
+        etag (str): The ETag the view assigns to the current representation.
+        if_none_match (werkzeug.datastructures.ETags): The request's If-None-Match header.
+        algorithms (list): The configured COMPRESS_ALGORITHM values.
 
-        if current_token_count + tokens_in_line > CHUNK_SIZE_TOKENS:
-            content_chunks.append(current_chunk.strip())  # Add chunk to list
-            current_chunk = ""  # Reset chunk
-            current_token_count = 0  # Reset token count
+    Returns:
+        str or None: The matching ETag, for setting on the 304.
+    """
+    for candidate in [etag, *(f"{etag}:{algorithm}" for algorithm in algorithms)]:
+        if if_none_match.contains(candidate):
+            return candidate
+    return None
+
+def iter_file_lines(stream, block_size=64 * 1024):
+    """
+    Decodes a binary stream as UTF-8 and yields its lines without reading it fully into memory.
+
+    Args:
+        stream: A binary file-like object, e.g. an uploaded file's ``stream``.
+        block_size (int): Number of bytes read per iteration.
+
+    Yields:
+        str: Each line without its line terminator, as ``str.splitlines`` would produce.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+
+        lines = (pending + decoder.decode(block)).splitlines(keepends=True)
+        # The last line may be incomplete (or a '\r' whose '\n' is in the next block)
+        pending = lines.pop() if lines else ''
+        for line in lines:
+            yield line.splitlines()[0]
 
-        current_chunk += line + "\n"
-        current_token_count += tokens_in_line
+    yield from (pending + decoder.decode(b'', final=True)).splitlines()
+
+def split_into_chunks(lines):
+    """Groups file lines into chunks of at most CHUNK_SIZE_TOKENS tokens."""
+    content_chunks = []
+    current_chunk_lines = []
+    current_token_count = 0
+
+    lines = iter(lines)
+    for batch in iter(lambda: list(itertools.islice(lines, TOKENIZE_BATCH_LINES)), []):
+        # File content is plain text, so special-token markers are counted as ordinary text
+        for line, tokens_in_line in zip(batch, count_tokens_batch(batch)):
+            if current_token_count + tokens_in_line > CHUNK_SIZE_TOKENS and current_chunk_lines:
+                # Join once per chunk instead of re-copying the growing chunk for every line
+                content_chunks.append("\n".join(current_chunk_lines).strip())  # Add chunk to list
+                current_chunk_lines = []  # Reset chunk
+                current_token_count = 0  # Reset token count
+
+            if tokens_in_line > CHUNK_SIZE_TOKENS:
+                # A single line over the limit (e.g. minified JSON) is cut into windows of token IDs
+                ids = tpool.execute(get_tokenizer().encode_ordinary, line)
+                content_chunks.extend(
+                    get_tokenizer().decode(ids[start:start + CHUNK_SIZE_TOKENS])
+                    for start in range(0, len(ids), CHUNK_SIZE_TOKENS)
+                )
+                continue
+
+            current_chunk_lines.append(line)
+            current_token_count += tokens_in_line
 
     # Add trailing content as the last chunk
-    if current_chunk.strip():
-        content_chunks.append(current_chunk.strip())
+    last_chunk = "\n".join(current_chunk_lines).strip()
+    if last_chunk:
+        content_chunks.append(last_chunk)
 
-    full_analysis_result = ""
-    for i, chunk in enumerate(content_chunks):
-        analysis = analyze_chunk_with_llama(chunk)
-        full_analysis_result += f"\n-- Analysis for Chunk {i + 1} --\n{analysis}"
+    return content_chunks
 
-    return content_chunks, full_analysis_result
+def analyze_chunks(content_chunks, conversation_history=()):
+    """Analyzes chunks concurrently via Llama API and joins the results in chunk order."""
+    pool = eventlet.GreenPool(ANALYSIS_CONCURRENCY)
+    analyses = pool.imap(lambda chunk: analyze_chunk_with_llama(chunk, conversation_history), content_chunks)
 
-def analyze_chunk_with_llama(chunk, retries=3):
-    """Analyzes a text chunk using the Llama API, with error handling and retries."""
-    conversation_history = session.get('conversation', [])
-    conversation_history.append({"role": "user", "content": chunk})
+    return "".join(f"\n-- Analysis for Chunk {i + 1} --\n{analysis}" for i, analysis in enumerate(analyses))
 
+def handle_file_chunks(lines):
+    """Break file lines into smaller tokenized chunks and analyze them concurrently via Llama API."""
+    content_chunks = split_into_chunks(lines)
+    # Read the session once here; the analysis greenlets run outside the request context
+    return content_chunks, analyze_chunks(content_chunks, session.get('conversation', []))
+
+def analyze_chunk_with_llama(chunk, conversation_history=()):
+    """Analyzes a text chunk using the Llama API, with error handling (transient failures are retried by azure_session)."""
     payload = {
-        "messages": conversation_history,
+        "messages": [*conversation_history, {"role": "user", "content": chunk}],
         "max_tokens": 500,
         "temperature": 0.7
     }
 
-    attempt = 0
-    while attempt < retries:
-        try:
-            response = requests.post(AZURE_API_URL, headers=HEADERS, json=payload)
-            response.raise_for_status()
-            llama_response = response.json()
-            return llama_response['choices'][0]['message']['content']
-        except (requests.exceptions.RequestException, KeyError) as e:
-            print(f"API error: {e}")
-            attempt += 1
-            if attempt >= retries:
-                return "Unable to process your request at this time. Please try again later."
\ No newline at end of file
+    try:
+        with analysis_slots:
+            response = post_completion(orjson.dumps(payload))
+        response.raise_for_status()
+        llama_response = orjson.loads(response.content)
+        return llama_response['choices'][0]['message']['content']
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError, KeyError) as e:
+        logging.error(f"API error while analyzing chunk: {e}")
+        return "Unable to process your request at this time. Please try again later."